@@ -5,30 +5,45 @@ Requires snowflake connector for python
 """
 
 import asyncio
+import functools
+import os
+import queue
+import re
+import sys
 import threading
-import warnings
-from contextlib import contextmanager
+import time
+import types
+import uuid
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.db import DatabaseError as WrappedDatabaseError, connections
 from django.db.backends.base.base import BaseDatabaseWrapper
 from django.db.backends.utils import (
     CursorDebugWrapper as BaseCursorDebugWrapper,
+    CursorWrapper as BaseCursorWrapper, strip_quotes,
 )
 from django.utils.asyncio import async_unsafe
-from django.utils.functional import cached_property
-from django.utils.safestring import SafeString
-from django.utils.version import get_version_tuple
+from django.utils.functional import cached_property, classproperty
+
+# The connector (and pyarrow, cryptography, requests... behind it) is only
+# imported once a connection is actually needed, so management commands that
+# never touch the database don't pay for it.
+Database = None
+
+
+def _load_driver():
+    global Database
+    if Database is None:
+        try:
+            import snowflake.connector as Database
+        except ImportError as e:
+            raise ImproperlyConfigured("Error loading snowflake connector module: %s" % e)
+    return Database
 
-try:
-    import snowflake.connector as Database
-except ImportError as e:
-    raise ImproperlyConfigured("Error loading snowflake connector module: %s" % e)
 
 # TODO: add versioning checks
 
-# Some of these import snowflake connector, so import them after checking if it's installed.
 from .client import DatabaseClient                          # NOQA isort:skip
 from .creation import DatabaseCreation                      # NOQA isort:skip
 from .features import DatabaseFeatures                      # NOQA isort:skip
@@ -37,10 +52,86 @@ from .operations import DatabaseOperations                  # NOQA isort:skip
 from .schema import DatabaseSchemaEditor                    # NOQA isort:skip
 
 
+def _async_unsafe(func):
+    """
+    Like django.utils.asyncio.async_unsafe, but use the cheap
+    asyncio._get_running_loop() probe on the sync path instead of
+    get_event_loop(), and only defer to Django's check when a loop is
+    actually running in this thread.
+    """
+    checked = async_unsafe(func)
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        if asyncio._get_running_loop() is None:
+            return func(*args, **kwargs)
+        return checked(*args, **kwargs)
+    return inner
+
+
+def _frozen_sql_map(mapping):
+    # Read-only view with interned values; these maps are shared by every
+    # thread and read each time a field or lookup is compiled.
+    return types.MappingProxyType({key: sys.intern(value) for key, value in mapping.items()})
+
+
+# Idle connections, keyed by the parameters they were opened with.
+# Logging in to Snowflake (HTTPS + authentication) dominates the cost of
+# opening a connection, so connections closed by Django are parked here and
+# handed out again instead of being thrown away.
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+
+def _freeze(value):
+    # Hashable, order-independent copy of a connection parameter value, so
+    # nested dicts such as session_parameters can be part of a pool key.
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _get_pool(key, maxsize):
+    with _POOL_LOCK:
+        pool = _POOL.get(key)
+        if pool is None:
+            pool = _POOL[key] = queue.Queue(maxsize)
+        return pool
+
+
+def close_pool():
+    """Close every idle pooled connection, e.g. on shutdown."""
+    with _POOL_LOCK:
+        pools = list(_POOL.values())
+        _POOL.clear()
+    for pool in pools:
+        while True:
+            try:
+                connection = pool.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+
+
+def _reset_pool_after_fork():
+    # The parent's connections share sessions and sockets with the parent, so
+    # a forked child must never check them out. Drop them without closing,
+    # which would log the parent's sessions out.
+    global _POOL_LOCK
+    _POOL_LOCK = threading.Lock()
+    _POOL.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
 class DatabaseWrapper(BaseDatabaseWrapper):
     vendor = 'snowflake'
     display_name = 'Snowflake'
-    data_types = {
+    data_types = _frozen_sql_map({
         'AutoField': 'NUMBER(38, 0) AUTOINCREMENT START 1 INCREMENT 1',
         'BigAutoField': 'NUMBER(38, 0)',
         'BinaryField': 'BINARY',
@@ -69,13 +160,13 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         'TextField': 'VARCHAR',
         'TimeField': 'TIME',
         'UUIDField': 'VARCHAR',
-    }
-    data_type_check_constraints = {
+    })
+    data_type_check_constraints = _frozen_sql_map({
         'PositiveBigIntegerField': '"%(column)s" >= 0',
         'PositiveIntegerField': '"%(column)s" >= 0',
         'PositiveSmallIntegerField': '"%(column)s" >= 0',
-    }
-    operators = {
+    })
+    operators = _frozen_sql_map({
         'exact': '= %s',
         'iexact': '= UPPER(%s)',
         'contains': 'LIKE %s',
@@ -90,18 +181,19 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         'endswith': 'LIKE %s',
         'istartswith': 'LIKE UPPER(%s)',
         'iendswith': 'LIKE UPPER(%s)',
-    }
-    pattern_esc = r"REPLACE(REPLACE(REPLACE({}, E'\\', E'\\\\'), E'%%', E'\\%%'), E'_', E'\\_')"
-    pattern_ops = {
+    })
+    # Prefix every backslash, % and _ with a backslash in a single regex pass.
+    pattern_esc = sys.intern(r"REGEXP_REPLACE({}, '([\\\\%%_])', '\\\\\\1')")
+    pattern_ops = _frozen_sql_map({
         'contains': "LIKE '%%' || {} || '%%'",
         'icontains': "LIKE '%%' || UPPER({}) || '%%'",
         'startswith': "LIKE {} || '%%'",
         'istartswith': "LIKE UPPER({}) || '%%'",
         'endswith': "LIKE '%%' || {}",
         'iendswith': "LIKE '%%' || UPPER({})",
-    }
+    })
 
-    Database = Database
+    Database = classproperty(lambda cls: _load_driver())
     SchemaEditorClass = DatabaseSchemaEditor
 
     # Classes instantiated in __init__().
@@ -111,80 +203,260 @@ class DatabaseWrapper(BaseDatabaseWrapper):
     introspection_class = DatabaseIntrospection
     ops_class = DatabaseOperations
 
-    def get_connection_params(self):
-        settings_dict = self.settings_dict
-        conn_params = {}
-
-        if settings_dict['DATABASE']:
-            conn_params['database'] = settings_dict['DATABASE']
-        else:
-            raise ImproperlyConfigured("Please provide a username for snowflake!")
-
-        if settings_dict['USER']:
-            conn_params['user'] = settings_dict['USER']
-        else:
-            raise ImproperlyConfigured("Please provide a username for snowflake!")
-
-        if settings_dict['PASSWORD']:
-            conn_params['password'] = settings_dict['PASSWORD']
-        else:
-            raise ImproperlyConfigured("Please provide a password for snowflake!")
-
-        if settings_dict['ACCOUNT']:
-            conn_params['account'] = settings_dict['ACCOUNT']
-        else:
-            raise ImproperlyConfigured("Please provide an account for snowflake!")
+    # Settings required to connect, mapped to their connector parameter.
+    REQUIRED_PARAMS = (
+        ('DATABASE', 'database'),
+        ('USER', 'user'),
+        ('PASSWORD', 'password'),
+        ('ACCOUNT', 'account'),
+        ('WAREHOUSE', 'warehouse'),
+        ('ROLE', 'role'),
+        ('SCHEMA', 'schema'),
+    )
+    # Required settings that may be empty, e.g. PASSWORD when OPTIONS selects
+    # an authenticator that doesn't use one.
+    EMPTY_PARAMS = frozenset({'PASSWORD'})
+    # Seconds after a successful probe during which is_usable() skips the
+    # round-trip to Snowflake.
+    usable_check_interval = 5.0
+    # OPTIONS consumed by the backend itself rather than the connector.
+    backend_options = frozenset({'POOL_SIZE', 'HEARTBEAT'})
 
-        if settings_dict['WAREHOUSE']:
-            conn_params['warehouse'] = settings_dict['WAREHOUSE']
-        else:
-            raise ImproperlyConfigured("Please provide a warehouse for snowflake!")
+    def get_connection_params(self):
+        # Return a copy so callers can't alter the cached parameters.
+        return dict(self._conn_params_cached)
 
-        if settings_dict['ROLE']:
-            conn_params['role'] = settings_dict['ROLE']
-        else:
-            raise ImproperlyConfigured("Please provide a role for snowflake!")
+    @cached_property
+    def _conn_params_cached(self):
+        # Built once per wrapper. Code that edits settings_dict after the
+        # first connect must `del connection._conn_params_cached` for the
+        # change to be picked up.
+        return self._build_connection_params()
 
-        if settings_dict['SCHEMA']:
-            conn_params['schema'] = settings_dict['SCHEMA']
-        else:
-            raise ImproperlyConfigured("Please provide a schema for snowflake!")
+    def _build_connection_params(self):
+        settings_dict = self.settings_dict
+        missing = [
+            key for key, _ in self.REQUIRED_PARAMS
+            if not (settings_dict.get(key) or (key in self.EMPTY_PARAMS and key in settings_dict))
+        ]
+        if missing:
+            raise ImproperlyConfigured(
+                "Please provide the following settings for snowflake: %s" % ', '.join(missing)
+            )
+        conn_params = {target: settings_dict[key] for key, target in self.REQUIRED_PARAMS}
 
+        # Keep the session alive between requests so an idle connection
+        # doesn't have to log in again before its next query. Anything in
+        # OPTIONS, other than the backend's own settings, is passed through
+        # to the connector and may override these.
+        options = settings_dict.get('OPTIONS', {})
+        conn_params.setdefault('client_session_keep_alive', True)
+        conn_params.setdefault('client_session_keep_alive_heartbeat_frequency', 3600)
+        conn_params.update(
+            (key, value) for key, value in options.items()
+            if key not in self.backend_options
+        )
+        # Heartbeats must come more often than Snowflake's session token
+        # expires, or pooled connections die while idle; never go above an
+        # hour.
+        conn_params['client_session_keep_alive_heartbeat_frequency'] = min(
+            options.get('HEARTBEAT', conn_params['client_session_keep_alive_heartbeat_frequency']),
+            3600,
+        )
         return conn_params
 
-    @async_unsafe
+    @cached_property
+    def pool_size(self):
+        """
+        Maximum number of idle connections kept around. Pooling is off by
+        default (0): a pooled session keeps any state set on it, such as USE
+        SCHEMA, ALTER SESSION, temporary tables and session variables.
+        """
+        return self.settings_dict['OPTIONS'].get('POOL_SIZE', 0)
+
+    @_async_unsafe
     def get_new_connection(self, conn_params):
-        connection = Database.connect(**conn_params)
+        if self.pool_size > 0:
+            # Key on the parameters themselves, not their hash, so a
+            # connection is never handed to a caller with other credentials.
+            # The alias and time zone are included because pooled sessions
+            # keep the QUERY_TAG and TIMEZONE set by init_connection_state().
+            self._pool_key = (
+                self.alias,
+                self.timezone_name if settings.USE_TZ else None,
+                _freeze(conn_params),
+            )
+            pool = _get_pool(self._pool_key, self.pool_size)
+            while True:
+                try:
+                    connection = pool.get_nowait()
+                except queue.Empty:
+                    break
+                # Django treats the connection it gets back as freshly
+                # opened and skips its health check, so make sure a pooled
+                # session hasn't died on the server while idle.
+                if connection.is_closed() is False and self._check_usable(connection):
+                    return connection
+                connection.close()
+        connection = _load_driver().connect(**conn_params)
         return connection
 
+    async def aget_new_connection(self, conn_params):
+        # The wrapper's state belongs to one thread, so run on the
+        # thread-sensitive executor, where Django's async ORM uses it too.
+        return await sync_to_async(self._thread_checked(self.get_new_connection))(conn_params)
+
+    def _thread_checked(self, func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            self.validate_thread_sharing()
+            return func(*args, **kwargs)
+        return inner
+
     def init_connection_state(self):
-        pass
+        # Pooled connections keep their session state, so only a newly opened
+        # connection needs setting up.
+        if getattr(self.connection, '_session_initialized', False):
+            return
+        # Set every session parameter in a single ALTER SESSION rather than
+        # paying a round-trip for each.
+        session_params = ["QUERY_TAG = 'django-%s'" % self.alias]
+        if settings.USE_TZ:
+            session_params.append("TIMEZONE = '%s'" % self.timezone_name)
+        session_sql = 'ALTER SESSION SET ' + ', '.join(session_params)
+        with self.connection.cursor() as cursor:
+            # _no_results submits the statement without waiting for it to
+            # finish; only use it for statements whose output and effect the
+            # following queries don't depend on. A QUERY_TAG may be applied a
+            # moment late, but TIMEZONE must be in place before the next query.
+            cursor.execute(session_sql, _no_results=not settings.USE_TZ)
+        self.connection._session_initialized = True
 
-    @async_unsafe
+    @_async_unsafe
     def create_cursor(self, name=None):
+        """
+        Return a connector cursor.
+
+        executemany() on these cursors already costs a single round-trip for
+        INSERT ... VALUES statements: with the pyformat paramstyle Django
+        uses, the connector folds all parameter rows into one multi-row
+        INSERT. Don't switch the connector to qmark binding to get bind
+        arrays; Django's SQL is written with %s placeholders.
+        """
         cursor = self.connection.cursor()
         return cursor
 
+    def arrow_cursor(self):
+        """
+        Return a cursor for bulk reads that don't need model instances, to be
+        consumed column-wise with cursor.fetch_arrow_batches() or
+        cursor.fetch_pandas_batches(). The connector receives results in Arrow
+        format by default, so the session's result format is left alone and
+        other cursors are unaffected. This needs pyarrow (the connector's
+        pandas extra), and scaled NUMBER columns come back as float unless
+        OPTIONS sets arrow_number_to_decimal.
+        """
+        return self.cursor()
+
+    def make_cursor(self, cursor):
+        return CursorWrapper(cursor, self)
+
+    def make_debug_cursor(self, cursor):
+        return CursorDebugWrapper(cursor, self)
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # Only hand back connections that are known to be clean: no
+                # open transaction and no error since the last health check.
+                if (self.pool_size > 0 and self.autocommit and not self.errors_occurred and
+                        self.connection.is_closed() is False):
+                    try:
+                        _get_pool(self._pool_key, self.pool_size).put_nowait(self.connection)
+                        return
+                    except queue.Full:
+                        pass
+                return self.connection.close()
+
     def _set_autocommit(self, autocommit):
         with self.wrap_database_errors:
             self.connection.autocommit = autocommit
 
     def is_usable(self):
+        # A cached probe isn't trusted once a database error has occurred.
+        if self.errors_occurred:
+            self.connection._last_usable_check = None
+        return self._check_usable(self.connection)
+
+    def _check_usable(self, connection):
+        # The result of a successful probe is remembered on the connection
+        # itself, so it carries over when a pooled connection is reused.
+        now = time.monotonic()
+        last_check = getattr(connection, '_last_usable_check', None)
+        if last_check is not None and now - last_check < self.usable_check_interval:
+            return True
         try:
             # Use a cursor directly, bypassing Django's utilities.
-            with self.connection.cursor() as cursor:
+            with connection.cursor() as cursor:
                 cursor.execute('SELECT current_version()')
-        except Database.Error:
+        except self.Database.Error:
+            connection._last_usable_check = None
             return False
         else:
+            connection._last_usable_check = now
             return True
 
+    async def ais_usable(self):
+        return await sync_to_async(self._thread_checked(self.is_usable))()
+
+
+class CursorWrapper(BaseCursorWrapper):
+    # User stage that files pass through on their way in or out of Snowflake.
+    # Every call gets its own path under it, so leftovers from earlier calls
+    # or concurrent copies of the same table are never picked up.
+    copy_stage = '@~/django_copy_stage'
+
+    def _copy_stage_path(self, table):
+        # Stage paths aren't quoted like identifiers, so only keep characters
+        # that are safe unquoted.
+        return '%s/%s/%s/' % (
+            self.copy_stage,
+            re.sub(r'\W', '_', strip_quotes(table), flags=re.ASCII),
+            uuid.uuid4().hex,
+        )
+
+    def _local_url(self, path):
+        # Local paths end up inside a string literal, so escape backslashes
+        # and quotes.
+        return "'file://%s'" % path.replace('\\', '\\\\').replace("'", "\\'")
+
+    def copy_expert(self, table, file):
+        """
+        Bulk load the local file at path `file` into `table`: upload it to a
+        stage with PUT, then load it server-side with COPY INTO. Return the
+        COPY INTO result rows.
+        """
+        stage = self._copy_stage_path(table)
+        try:
+            self.execute('PUT %s %s AUTO_COMPRESS=TRUE PARALLEL=4' % (self._local_url(file), stage))
+            self.execute('COPY INTO %s FROM %s' % (self.db.ops.quote_name(table), stage))
+            return self.fetchall()
+        finally:
+            self.execute('REMOVE %s' % stage)
+
+    def copy_to(self, file, table):
+        """
+        Unload `table` into the local directory `file`: COPY INTO a stage, then
+        download the resulting files with GET. Return the GET result rows.
+        """
+        stage = self._copy_stage_path(table)
+        try:
+            self.execute('COPY INTO %s FROM %s' % (stage, self.db.ops.quote_name(table)))
+            self.execute('GET %s %s PARALLEL=4' % (stage, self._local_url(file)))
+            return self.fetchall()
+        finally:
+            self.execute('REMOVE %s' % stage)
 
-class CursorDebugWrapper(BaseCursorDebugWrapper):
-    def copy_expert(self, sql, file, *args):
-        with self.debug_sql(sql):
-            return self.cursor.copy_expert(sql, file, *args)
 
-    def copy_to(self, file, table, *args, **kwargs):
-        with self.debug_sql(sql='COPY %s TO STDOUT' % table):
-            return self.cursor.copy_to(file, table, *args, **kwargs)
+class CursorDebugWrapper(BaseCursorDebugWrapper, CursorWrapper):
+    pass
@@ -1,6 +1,5 @@
 from django.conf import settings
 from django.db.backends.base.operations import BaseDatabaseOperations
-import snowflake.connector as Database
 
 
 class DatabaseOperations(BaseDatabaseOperations):
@@ -49,7 +48,7 @@ class DatabaseOperations(BaseDatabaseOperations):
             with self.connection.cursor() as cursor:
                 cursor.execute('SET qid = last_query_id()')
         # TODO: map exception here
-        except Database.errors.ProgrammingError as e:
+        except self.connection.Database.errors.ProgrammingError as e:
             # default error message
             print(e)
             # customer error message
@@ -63,7 +62,7 @@ class DatabaseOperations(BaseDatabaseOperations):
                 last_row_id, = cursor.execute(set_statement_id_sql).fetchone()
                 return last_row_id
         # TODO: map exception here
-        except Database.errors.ProgrammingError as e:
+        except self.connection.Database.errors.ProgrammingError as e:
             # default error message
             print(e)
             # customer error message
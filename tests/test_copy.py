@@ -0,0 +1,58 @@
+from unittest import TestCase, mock
+
+from snowflake import base
+from snowflake.base import CursorWrapper
+
+from .test_pool import FakeDriver, make_wrapper
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        return self
+
+    def fetchall(self):
+        return []
+
+
+class CopyTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(base, '_load_driver', FakeDriver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.raw_cursor = RecordingCursor()
+        self.cursor = CursorWrapper(self.raw_cursor, make_wrapper())
+
+    def test_local_path_is_escaped(self):
+        self.cursor.copy_expert('table', "/tmp/it's\\data.csv")
+        put = self.raw_cursor.statements[0]
+        self.assertTrue(put.startswith("PUT 'file:///tmp/it\\'s\\\\data.csv' "), put)
+
+    def test_copy_expert_uses_a_fresh_stage_path(self):
+        self.cursor.copy_expert('"my table"', '/tmp/data.csv')
+        self.cursor.copy_expert('"my table"', '/tmp/data.csv')
+        statements = self.raw_cursor.statements
+        first_stage = statements[0].split()[2]
+        second_stage = statements[3].split()[2]
+        self.assertTrue(first_stage.startswith('@~/django_copy_stage/my_table/'), first_stage)
+        self.assertNotEqual(first_stage, second_stage)
+        self.assertEqual(statements[:3], [
+            "PUT 'file:///tmp/data.csv' %s AUTO_COMPRESS=TRUE PARALLEL=4" % first_stage,
+            'COPY INTO "my table" FROM %s' % first_stage,
+            'REMOVE %s' % first_stage,
+        ])
+
+    def test_copy_to_removes_stage_path_on_error(self):
+        def execute(sql, params=None):
+            self.raw_cursor.statements.append(sql)
+            if sql.startswith('GET'):
+                raise OSError('disk full')
+        self.raw_cursor.execute = execute
+        with self.assertRaises(OSError):
+            self.cursor.copy_to('/tmp/out/', 'table')
+        copy, get, remove = self.raw_cursor.statements
+        stage = copy.split()[2]
+        self.assertEqual(remove, 'REMOVE %s' % stage)
@@ -0,0 +1,220 @@
+import time
+from unittest import TestCase, mock
+
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import DatabaseError
+
+if not settings.configured:
+    settings.configure(USE_TZ=True)
+    django.setup()
+
+from snowflake import base  # NOQA isort:skip
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, *args, **kwargs):
+        if self.connection.dead:
+            raise FakeError('session expired')
+        self.connection.queries.append(sql)
+        return self
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.dead = False
+        self.queries = []
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeDriver:
+    # Django's DatabaseErrorWrapper looks up every DB-API exception class.
+    Error = InterfaceError = DatabaseError = FakeError
+    DataError = OperationalError = IntegrityError = FakeError
+    InternalError = ProgrammingError = NotSupportedError = FakeError
+
+    def connect(self, **conn_params):
+        return FakeConnection()
+
+
+def make_wrapper(alias='default', time_zone=None, **options):
+    return base.DatabaseWrapper({
+        'DATABASE': 'db', 'USER': 'user', 'PASSWORD': 'secret', 'ACCOUNT': 'account',
+        'WAREHOUSE': 'wh', 'ROLE': 'role', 'SCHEMA': 'schema',
+        'OPTIONS': options, 'TIME_ZONE': time_zone,
+        'AUTOCOMMIT': True, 'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False,
+    }, alias)
+
+
+class PoolTests(TestCase):
+    def setUp(self):
+        base._POOL.clear()
+        patcher = mock.patch.object(base, '_load_driver', FakeDriver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(base._POOL.clear)
+
+    def reconnect(self, wrapper):
+        first = wrapper.connection
+        wrapper.close()
+        wrapper.connect()
+        return first
+
+    def test_disabled_by_default(self):
+        wrapper = make_wrapper()
+        wrapper.connect()
+        first = self.reconnect(wrapper)
+        self.assertTrue(first.closed)
+        self.assertIsNot(wrapper.connection, first)
+
+    def test_reuses_connection(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        first = self.reconnect(wrapper)
+        self.assertFalse(first.closed)
+        self.assertIs(wrapper.connection, first)
+
+    def test_not_returned_outside_autocommit(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        wrapper.set_autocommit(False)
+        first = self.reconnect(wrapper)
+        self.assertTrue(first.closed)
+        self.assertIsNot(wrapper.connection, first)
+
+    def test_not_returned_after_error(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        wrapper.errors_occurred = True
+        first = self.reconnect(wrapper)
+        self.assertTrue(first.closed)
+        self.assertIsNot(wrapper.connection, first)
+
+    def test_full_pool_closes_connection(self):
+        first, second = make_wrapper(POOL_SIZE=1), make_wrapper(POOL_SIZE=1)
+        first.connect()
+        second.connect()
+        first_connection, second_connection = first.connection, second.connection
+        first.close()
+        second.close()
+        self.assertFalse(first_connection.closed)
+        self.assertTrue(second_connection.closed)
+
+    def test_keyed_by_alias(self):
+        first, second = make_wrapper('first', POOL_SIZE=1), make_wrapper('second', POOL_SIZE=1)
+        first.connect()
+        pooled = first.connection
+        first.close()
+        second.connect()
+        self.assertIsNot(second.connection, pooled)
+
+    def test_keyed_by_time_zone(self):
+        first = make_wrapper(POOL_SIZE=1, time_zone='Europe/Paris')
+        second = make_wrapper(POOL_SIZE=1)
+        first.connect()
+        pooled = first.connection
+        first.close()
+        second.connect()
+        self.assertIsNot(second.connection, pooled)
+
+    def test_unhashable_options(self):
+        wrapper = make_wrapper(POOL_SIZE=1, session_parameters={'QUERY_TAG': 'x'})
+        wrapper.connect()
+        first = self.reconnect(wrapper)
+        self.assertIs(wrapper.connection, first)
+
+    def test_dead_connection_discarded_at_checkout(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        first = wrapper.connection
+        wrapper.close()
+        first.dead = True
+        first._last_usable_check = time.monotonic() - wrapper.usable_check_interval
+        wrapper.connect()
+        self.assertTrue(first.closed)
+        self.assertIsNot(wrapper.connection, first)
+
+    def test_recent_probe_skips_checkout_query(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        first = wrapper.connection
+        first._last_usable_check = time.monotonic()
+        first.queries.clear()
+        self.reconnect(wrapper)
+        self.assertIs(wrapper.connection, first)
+        self.assertEqual(first.queries, [])
+
+    def test_close_pool(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        first = wrapper.connection
+        wrapper.close()
+        base.close_pool()
+        self.assertTrue(first.closed)
+        self.assertEqual(base._POOL, {})
+
+    def test_fork_drops_pool_without_closing(self):
+        wrapper = make_wrapper(POOL_SIZE=1)
+        wrapper.connect()
+        first = wrapper.connection
+        wrapper.close()
+        base._reset_pool_after_fork()
+        self.assertEqual(base._POOL, {})
+        self.assertFalse(first.closed)
+
+
+class ConnectionParamsTests(TestCase):
+    def test_returns_a_copy(self):
+        wrapper = make_wrapper()
+        wrapper.get_connection_params()['user'] = 'other'
+        self.assertEqual(wrapper.get_connection_params()['user'], 'user')
+
+    def test_cache_invalidation(self):
+        wrapper = make_wrapper()
+        wrapper.get_connection_params()
+        wrapper.settings_dict['DATABASE'] = 'test_db'
+        del wrapper._conn_params_cached
+        self.assertEqual(wrapper.get_connection_params()['database'], 'test_db')
+
+
+class AsyncTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(base, '_load_driver', FakeDriver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ais_usable_on_owning_thread(self):
+        wrapper = make_wrapper()
+        wrapper.connect()
+        self.assertIs(async_to_sync(wrapper.ais_usable)(), True)
+
+    def test_ais_usable_rejects_foreign_thread(self):
+        wrapper = make_wrapper()
+        wrapper.connect()
+        # Simulate a wrapper owned by another thread.
+        wrapper._thread_ident = -1
+        with self.assertRaises(DatabaseError):
+            async_to_sync(wrapper.ais_usable)()